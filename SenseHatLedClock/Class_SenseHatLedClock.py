@@ -4,8 +4,15 @@ This is open-source code, use it as is.
 by Sziller @sziller.eu
 """
 
+import os
+import glob
+import mmap
 import time
+import struct
 import inspect
+from itertools import chain
+from collections import deque
+from types import MappingProxyType
 from SenseHatLedClock import graphic_settings as gs
 from SenseHatCustomExceptions import DisplayErrors as DiEr
 
@@ -21,6 +28,16 @@ except ImportError as e1:
     except ImportError as e2:
         raise DiEr.MissingDisplay()
 
+SENSE_HAT_FB_NAME = "RPi-Sense FB"  # name of the SenseHat's LED matrix framebuffer
+SENSE_HAT_FB_SIZE = 128  # 64 pixels, 2 bytes (RGB565) each
+
+# hour: perimeter cells lit to show it - default for logical_list_entry_dict_substitute
+HOUR_PERIMETER_CELLS = {0: [28, 1], 1: [2, 3, 4], 2: [4, 5, 6], 3: [7, 8], 4: [9, 10, 11], 5: [11, 12, 13],
+                        6: [14, 15], 7: [16, 17, 18], 8: [18, 19, 20], 9: [21, 22], 10: [23, 24, 25], 11: [25, 26, 27],
+                        12: [27, 2], 13: [2, 4], 14: [4, 6], 15: [6, 9], 16: [9, 11], 17: [11, 13],
+                        18: [13, 16], 19: [16, 18], 20: [18, 20], 21: [20, 23], 22: [23, 25], 23: [25, 27]}
+_HOUR_PERIMETER_CELL_SETS = {k: frozenset(v) for k, v in HOUR_PERIMETER_CELLS.items()}
+
 print("====================================")
 print("= LedClock using: {:^16} =".format({True: "SenseHat", False: "Emulator"}[LIVE]))
 print("====================================")
@@ -41,16 +58,30 @@ class LedClock:
                  numbers: dict = gs.NUMBERS_8x8,
                  perimeter: dict = gs.PERIMETER,
                  colortable: dict = gs.COLORTABLE,
+                 prerender: bool = False,
                  **kwargs  # to make instantiation tolerant to undefined keyword arguments
                  ):
         self.sense = SenseHat()
         self.sense.low_light            = low_light
+        self._fb_mmap                   = open_framebuffer() if LIVE else None  # None: display via set_pixels
         self.duration: int              = duration   # seconds to display clock - 0 means forever
-        self.heartbeat: int             = heartbeat  # seconds to wait between loops turns
-
-        self.numbers                    = numbers
-        self.perimeter                  = perimeter
-        self.colortable                 = colortable
+        self.heartbeat: int             = heartbeat  # max seconds to wait between loops turns
+        # 0: wait for next minute - exit_signal might only be noticed up to a minute later
+        self.prerender: bool            = prerender  # render all images of the clock style before run() loop starts
+
+        self._numbers                   = tuple_deep(numbers)  # read-only: change by reassigning only
+        self._perimeter                 = tuple_deep(perimeter)
+        self._colortable                = tuple_deep(colortable)
+
+        self._colors: tuple             = ()  # (background, number, perim) as of last precompute()
+        self.numbers_bits: dict         = {}  # digit: 64-bit mask of the digit's glyph, first pixel is MSB
+        self.flat_perimeter: tuple      = ()  # flat 64-tuple of perimeter cell indexes
+        self.perim_by_minute: dict      = {}  # (clock_style, minute): 64-bit mask of the lit perimeter
+        self.perim_by_hour: dict        = {}  # (clock_style, hour): 64-bit mask of the lit perimeter
+        self._frame_cache: dict         = {}  # (clock_style, hour, minute): rendered image
+        self._fb_bytes: dict            = {}  # (clock_style, hour, minute): rendered image packed for framebuffer
+        self._last_image                = None  # image currently on display
+        self.precompute()
 
         self.delta_t_h = -2  # time as returned by time.time - your time
         self.delta_t_m = 0
@@ -60,26 +91,108 @@ class LedClock:
         # 2: minutes as integer in center 6x6, hours as 2 or 3 pixel bar on perimeter - 12hour system
         # 3: minutes as integer in center 6x6, hours as 2 or 3 pixel bar (am) or 2 pixel range (pm) on perimeter - 24h
         self.clock_style: int           = clock_style
+        self._renderers: dict           = {0: self._render_center_hour,  # clock_style: method rendering it
+                                           1: self._render_center_hour,
+                                           2: self._render_center_minute,
+                                           3: self._render_center_minute}
         
         self.curr_time_string = ""
         
         self.exit_signal = True
 
+    @property
+    def numbers(self):
+        return self._numbers
+
+    @numbers.setter
+    def numbers(self, value):
+        self._numbers = tuple_deep(value)
+        self.precompute()
+
+    @property
+    def perimeter(self):
+        return self._perimeter
+
+    @perimeter.setter
+    def perimeter(self, value):
+        self._perimeter = tuple_deep(value)
+        self.precompute()
+
+    @property
+    def colortable(self):
+        return self._colortable
+
+    @colortable.setter
+    def colortable(self, value):
+        self._colortable = tuple_deep(value)
+        self.precompute()
+
+    def precompute(self):
+        """=== Method name: precompute =================================================================================
+        Method builds the static display data as 64-bit masks (one bit per LED), so update() only has to look them up.
+        Rerun whenever numbers, perimeter or colortable change - the setters do so automatically.
+        Already rendered images are dropped, as they might be outdated.
+        ========================================================================================== by Sziller ==="""
+        self._frame_cache = {}
+        self._fb_bytes = {}
+        self._last_image = None
+        self._colors = (self.colortable['background'], self.colortable['number'], self.colortable['perim'])
+        self.numbers_bits = {k: list_to_bits(list_flatten(v_matrix)) for k, v_matrix in self.numbers.items()}
+        self.flat_perimeter = tuple(list_flatten(self.perimeter))
+
+        self.perim_by_minute = {}
+        for style in (0, 1):
+            for minute in range(60):
+                min_unit = minute * (28.0 / 60) + 1  # 28 is the nr of perimeter cells
+                self.perim_by_minute[(style, minute)] = list_to_bits(
+                    logical_list_entry_limit_substitute(list_in=self.flat_perimeter,
+                                                        threshold=min_unit,
+                                                        false=0,
+                                                        true=1,
+                                                        is_line=style))
+        self.perim_by_hour = {}
+        for style in (2, 3):
+            for hour in range(24):
+                hour_unit = hour % (12 * (style - 1))
+                self.perim_by_hour[(style, hour)] = list_to_bits(
+                    logical_list_entry_dict_substitute(list_in=self.flat_perimeter,
+                                                       item=hour_unit,
+                                                       false=0,
+                                                       true=1))
+
     def run(self):
         """=== Method name: run ========================================================================================
         Method actually runs instance.
         ========================================================================================== by Sziller ==="""
         self.exit_signal = False
-        time_now = time.time()
+        # local names for everything used in the loop - spares attribute lookups on each turn
+        t, sleep, gm, strftime = time.time, time.sleep, time.gmtime, time.strftime
+        update = self.update
+
+        if self.prerender:
+            self.prerender_frames()
+
+        shown = None  # (clock_style, hour, minute) last sent to update()
+        time_now = t()
         time_at_end = time_now + self.duration
         while time_now <= time_at_end and not self.exit_signal:
             if self.duration:
-                time_now = time.time()  # if no duration defined, infinite loop
-            cst = time.time() - 3600 * self.delta_t_h - 60 * self.delta_t_m  # Current System Time
-            dst = time.gmtime(cst)  # Detailed System Time
-            self.curr_time_string = time.strftime("%H:%M", dst)
-            self.update()
-            time.sleep(self.heartbeat)
+                time_now = t()  # if no duration defined, infinite loop
+                if time_now >= time_at_end:
+                    break  # nothing is drawn after the duration ran out
+            cst = t() - 3600 * self.delta_t_h - 60 * self.delta_t_m  # Current System Time
+            dst = gm(cst)  # Detailed System Time
+            state = (self.clock_style, dst.tm_hour, dst.tm_min)
+            if state != shown or self._last_image is None:  # precompute() clears _last_image: redraw needed
+                shown = state
+                self.curr_time_string = strftime("%H:%M", dst)
+                update()
+            next_tick = 60 - (t() % 60) + 0.05  # wake right after the displayed minute rolls over
+            if self.heartbeat:
+                next_tick = min(next_tick, self.heartbeat)
+            if self.duration:
+                next_tick = min(next_tick, max(0, time_at_end - t()))
+            sleep(next_tick)
 
     def update(self):
         """=== Method name: update =====================================================================================
@@ -88,54 +201,157 @@ class LedClock:
         time_as_list = self.curr_time_string.split(":")
         hour, minute = int(time_as_list[0]), int(time_as_list[1])
 
-        bin_matrix_perim_comp = []
-
-        if self.clock_style in [0, 1]:
-            bin_matrix_hour = list_flatten(self.numbers[hour])
-            min_unit = minute * (28.0 / 60) + 1  # 28 is the nr of perimeter cells
-            for row in self.perimeter:
-                bin_matrix_perim_comp.append(logical_list_entry_limit_substitute(list_in=row,
-                                                                                 threshold=min_unit,
-                                                                                 false=0,
-                                                                                 true=1,
-                                                                                 is_line=self.clock_style))
-            bin_matrix_minutes = list_flatten(bin_matrix_perim_comp)
-            image = self.setup_display_area(bin_matrix_field=bin_matrix_hour, bin_matrix_perim=bin_matrix_minutes)
-        elif self.clock_style in [2, 3]:
-            bin_matrix_minutes = list_flatten(self.numbers[minute])
-            hour_unit = hour % (12 * (self.clock_style - 1))
-            for row in self.perimeter:
-                bin_matrix_perim_comp.append(logical_list_entry_dict_substitute(list_in=row,
-                                                                                item=hour_unit,
-                                                                                false=0,
-                                                                                true=1))
-            bin_matrix_hour = list_flatten(bin_matrix_perim_comp)
-            image = self.setup_display_area(bin_matrix_field=bin_matrix_minutes, bin_matrix_perim=bin_matrix_hour)
-        else:
-            print("[  ERROR]: No clock-style recognized. - sais {}".format(self.cmn))
-            image = False
-
+        image = self.cached_render(hour=hour, minute=minute)
         if image:
-            self.sense.set_pixels(image)
+            if image != self._last_image:  # display only if changed - pixels of cached images compare by identity
+                self._last_image = image
+                self.display(image, fb_bytes=self._fb_bytes.get((self.clock_style, hour, minute)))
         else:
             print("[  ERROR]: No image to display. - sais {}".format(self.cmn))
-        
-    def setup_display_area(self, bin_matrix_field, bin_matrix_perim):
-        """===Method name: setup_display_area ==========================================================================
-        Transforming binary matrix data into colored, led display information
+
+    def prerender_frames(self):
+        """=== Method name: prerender_frames ===========================================================================
+        Method renders and caches all 24 * 60 images of the current clock style, so no rendering is left for later
+        update() calls. Takes a moment on slower Pi models, hence off by default - see 'prerender' argument.
+        ========================================================================================== by Sziller ==="""
+        for hour in range(24):
+            for minute in range(60):
+                if not self.cached_render(hour=hour, minute=minute):
+                    return  # unknown clock style - reported by render()
+
+    def cached_render(self, hour: int, minute: int):
+        """=== Method name: cached_render ==============================================================================
+        Method returns the image of the given time in the current clock style, rendering and caching it on first use.
         ========================================================================================== by Sziller ==="""
-        col_matrix_field = logical_list_entry_substitute(bin_matrix_field,
-                                                         self.colortable['background'],
-                                                         self.colortable['number'])
-        col_matrix_perim = logical_list_entry_substitute(bin_matrix_perim,
-                                                         self.colortable['background'],
-                                                         self.colortable['perim'])
-        image = logical_list_combine_adv(col_matrix_perim,
-                                         col_matrix_field,
-                                         self.colortable['background'])
+        frame_cache = self._frame_cache
+        key = (self.clock_style, hour, minute)
+        image = frame_cache.get(key)
+        if image is None:
+            image = self.render(hour=hour, minute=minute)
+            if image:
+                frame_cache[key] = image
+                if self._fb_mmap is not None:
+                    self._fb_bytes[key] = pack_rgb565(image)
         return image
+
+    def display(self, image, fb_bytes: bytes or None = None):
+        """=== Method name: display ====================================================================================
+        Method writes image to the LED matrix. If available, the framebuffer is written directly in one go,
+        otherwise - or if the display is rotated - SenseHat's set_pixels is used.
+        fb_bytes: image already packed by pack_rgb565 - packed here if not given.
+        ========================================================================================== by Sziller ==="""
+        if self._fb_mmap is not None and not self.sense.rotation:
+            if fb_bytes is None:
+                fb_bytes = pack_rgb565(image)
+            self._fb_mmap.seek(0)
+            self._fb_mmap.write(fb_bytes)
+        else:
+            self.sense.set_pixels(image)
+
+    def render(self, hour: int, minute: int):
+        """=== Method name: render =====================================================================================
+        Method composes the image of the given time according to the clock style. Returns False if style is unknown.
+        ========================================================================================== by Sziller ==="""
+        renderer = self._renderers.get(self.clock_style)
+        if renderer is None:
+            print("[  ERROR]: No clock-style recognized. - sais {}".format(self.cmn))
+            return False
+        return renderer(hour, minute)
+
+    def _render_center_hour(self, hour: int, minute: int):
+        """=== Method name: _render_center_hour ========================================================================
+        Renderer of clock styles 0 and 1: hour in the center, minutes on the perimeter.
+        ========================================================================================== by Sziller ==="""
+        return self.setup_display_area(bits_field=self.numbers_bits[hour],
+                                       bits_perim=self.perim_by_minute[(self.clock_style, minute)])
+
+    def _render_center_minute(self, hour: int, minute: int):
+        """=== Method name: _render_center_minute ======================================================================
+        Renderer of clock styles 2 and 3: minutes in the center, hours on the perimeter.
+        ========================================================================================== by Sziller ==="""
+        return self.setup_display_area(bits_field=self.numbers_bits[minute],
+                                       bits_perim=self.perim_by_hour[(self.clock_style, hour)])
+
+    def setup_display_area(self, bits_field: int, bits_perim: int):
+        """===Method name: setup_display_area ==========================================================================
+        Transforming 64-bit field and perimeter masks into colored, led display information in a single pass.
+        Lit perimeter cells take precedence over the field. Colors are the ones captured by precompute(), so
+        every cached image shares them.
+        ========================================================================================== by Sziller ==="""
+        background, number, perim = self._colors
+        return render_frame(bits_field=bits_field,
+                            bits_perim=bits_perim,
+                            background=background,
+                            number=number,
+                            perim=perim)
         
         
+def find_framebuffer_device(fb_name: str = SENSE_HAT_FB_NAME):
+    """=== Function name: find_framebuffer_device ======================================================================
+    returns the /dev path of the framebuffer called fb_name, None if not found
+    ============================================================================================== by Sziller ==="""
+    for fb in glob.glob('/sys/class/graphics/fb*'):
+        name_file = os.path.join(fb, 'name')
+        if os.path.isfile(name_file):
+            with open(name_file, 'r') as f:
+                name = f.read().strip()
+            fb_device = os.path.join('/dev', os.path.basename(fb))
+            if name == fb_name and os.path.exists(fb_device):
+                return fb_device
+    return None
+
+
+def open_framebuffer(fb_name: str = SENSE_HAT_FB_NAME):
+    """=== Function name: open_framebuffer =============================================================================
+    returns a writable memory map of the SenseHat's LED framebuffer, None if it is not accessible
+    ============================================================================================== by Sziller ==="""
+    fb_device = find_framebuffer_device(fb_name=fb_name)
+    if fb_device is None:
+        return None
+    try:
+        fd = os.open(fb_device, os.O_RDWR)
+        try:
+            return mmap.mmap(fd, SENSE_HAT_FB_SIZE)
+        finally:
+            os.close(fd)  # mmap keeps its own handle
+    except OSError as e:
+        print("[WARNING]: Framebuffer {} not accessible: {}".format(fb_device, e))
+        return None
+
+
+def pack_rgb565(image) -> bytes:
+    """=== Function name: pack_rgb565 ==================================================================================
+    packs 64 [R,G,B] pixels into the SenseHat framebuffer's 16 bit RGB565, little-endian format
+    ============================================================================================== by Sziller ==="""
+    return struct.pack('<64H', *[((r >> 3) << 11) | ((g >> 2) << 5) | (b >> 3) for r, g, b in image])
+
+
+def tuple_deep(data):
+    """=== Function name: tuple_deep ===================================================================================
+    converts nested lists into nested tuples, dictionaries into read-only mappings with their values converted
+    ============================================================================================== by Sziller ==="""
+    if isinstance(data, (dict, MappingProxyType)):
+        return MappingProxyType({k: tuple_deep(v) for k, v in data.items()})
+    if isinstance(data, (list, tuple)):
+        return tuple(tuple_deep(_) for _ in data)
+    return data
+
+
+def render_frame(bits_field: int, bits_perim: int, background, number, perim) -> tuple:
+    """=== Function name: render_frame =================================================================================
+    fused kernel: turns 64-bit field and perimeter masks into a 64-tuple of pixel colors in one pass
+    lit perimeter cells take precedence over the field
+    ============================================================================================== by Sziller ==="""
+    answer = [background] * 64
+    for i in range(64):
+        shift = 63 - i
+        if (bits_perim >> shift) & 1:
+            answer[i] = perim
+        elif (bits_field >> shift) & 1:
+            answer[i] = number
+    return tuple(answer)
+
+
 def logical_list_entry_limit_substitute(list_in, threshold, false, true, is_line=1):
     """=== Function name: logical_list_entry_limit_substitute ==========================================================
     converts logical lists entries into entries represented by "false" or "true"
@@ -161,13 +377,10 @@ def logical_list_entry_dict_substitute(list_in, item, false, true, dict_in: dict
     WARNING! 'false' and 'true' are not capitalized. These are agrumens, not boolean values!!!
     ============================================================================================== by Sziller ==="""
     if dict_in is not None:
-        data = dict_in
+        cells = frozenset(dict_in[item])
     else:
-        data = {0: [28, 1], 1: [2, 3, 4], 2: [4, 5, 6], 3: [7, 8], 4: [9, 10, 11], 5: [11, 12, 13],
-                6: [14, 15], 7: [16, 17, 18], 8: [18, 19, 20], 9: [21, 22], 10: [23, 24, 25], 11: [25, 26, 27],
-                12: [27, 2], 13: [2, 4], 14: [4, 6], 15: [6, 9], 16: [9, 11], 17: [11, 13],
-                18: [13, 16], 19: [16, 18], 20: [18, 20], 21: [20, 23], 22: [23, 25], 23: [25, 27]}
-    return [true if _ in data[item] else false for _ in list_in]
+        cells = _HOUR_PERIMETER_CELL_SETS[item]
+    return [true if _ in cells else false for _ in list_in]
 
 
 def list_display_dundle(list_in: list, sequence_length: int):
@@ -189,24 +402,15 @@ def list_display_dundle(list_in: list, sequence_length: int):
 def data_leading_zero(integer: int, digits: int):
     """=== Method name: data_leading_zero ==============================================================================
     ============================================================================================== by Sziller ==="""
-    str_integer = str(int(integer))
-    act_digits = len(str_integer)
-    lead = ""
-    for _ in range(digits - act_digits):
-        lead += '0'
-    return lead + str_integer
+    return str(int(integer)).zfill(digits)
 
 
 def fifo_list(list_in: list, data_in, max_length: int = 0):
     """=== Method name: fifo_list ======================================================================================
         ============================================================================================== by Sziller ==="""
-    answer = list(list_in)
-    if not max_length:
-        max_length = len(answer)
+    answer = deque(list_in, maxlen=max_length or len(list_in))
     answer.append(data_in)
-    while len(answer) > max_length:
-        del answer[0]
-    return answer
+    return list(answer)
 
 
 def list_dict_fifo_extend_w_dist(listdict: dict, dict_in: dict, max_length=10):
@@ -221,41 +425,26 @@ def list_dict_fifo_extend_w_dist(listdict: dict, dict_in: dict, max_length=10):
 def logical_list_combine(list_base, list_add):
     """=== Method name: logical_list_combine ===========================================================================
         ============================================================================================== by Sziller ==="""
-    counter = 0
-    total = len(list_base)
-    answer = []
-    while counter < total:
-        list_base_i = list_base[counter]
-        if list_base_i:
-            answer.append(list_base_i)
-        else:
-            answer.append(list_add[counter])
-        counter += 1
-    return answer
+    return [b if b else a for b, a in zip(list_base, list_add)]
 
 
 def logical_list_combine_adv(list_base, list_add, neutral):
     """=== Method name: logical_list_combine_adv =======================================================================
     ============================================================================================== by Sziller ==="""
-    counter = 0
-    total = len(list_base)
-    answer = []
-    while counter < total:
-        list_base_i = list_base[counter]
-        if list_base_i and list_base_i != neutral:
-            answer.append(list_base_i)
-        else:
-            answer.append(list_add[counter])
-        counter += 1
-    return answer
+    return [b if (b and b != neutral) else a for b, a in zip(list_base, list_add)]
 
 
 def list_flatten(list_in):
     """=== Method name: list_flatten ===================================================================================
     ============================================================================================== by Sziller ==="""
-    answer = []
-    for x in list_in:
-        for y in x:
-            answer.append(y)
-    return answer
+    return list(chain.from_iterable(list_in))
 
+
+def list_to_bits(list_in) -> int:
+    """=== Function name: list_to_bits =================================================================================
+    packs logical list entries into a single integer bitmask, first entry being the most significant bit
+    ============================================================================================== by Sziller ==="""
+    answer = 0
+    for _ in list_in:
+        answer = (answer << 1) | (1 if _ else 0)
+    return answer